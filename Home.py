@@ -1,7 +1,8 @@
 import streamlit as st
-import pandas as pd
 
-from functions import init_connection, build_category_cpi_df
+from concurrent.futures import as_completed
+from functions import (build_us_cpi_df, build_us_jolts_df, check_freshness, get_query_tables, get_series_store, load_materialized,
+    start_cache_warmer, submit_queries, us_annual_cpi_query, us_employment_query, PageMetrics, US_CPI_SERIES, US_JOLTS_SERIES)
 
 st.set_page_config(
      page_title="U.S. Bureau of labor statistics",
@@ -9,102 +10,30 @@ st.set_page_config(
      layout="wide",
      initial_sidebar_state="expanded"
 )
+page_metrics = PageMetrics('Home')
 
 st.title('🧊 Bureau of Labor Statistics: CPI, JOLTS, Employment and Unemployment')
 st.subheader('The Bureau of Labor Statistics (BLS) publishes the Consumer Price Index (CPI), Average Prices (AP), Job Openings and Labor Turnover Survey (JOLTS), State and Metro Area Employment , Hours, & Earnings (SAE), Local Area Unemployment Statistics (LAUS) on a monthly basis.')
 
-conn = init_connection()
-cur = conn.cursor()
-
-# Load data table
-@st.cache_resource
-def load_us_annual_cpi_data(): 
-    cur.execute("SELECT VARIABLE, VARIABLE_NAME, VALUE, DATE FROM BLS_PRICE_TIMESERIES "
-        + "WHERE GEO_ID = 'country/USA' AND VARIABLE LIKE '%_Not_seasonally_adjusted,_Annual%'")
-    return cur.fetch_pandas_all()
-
-@st.cache_resource
-def load_us_employment_data():
-    cur.execute("SELECT ts.variable, VALUE, DATE, MEASURE, INDUSTRY "
-        + "FROM bls_employment_timeseries as ts "
-        + "JOIN cybersyn.bls_employment_attributes AS att ON (ts.variable = att.variable) "
-        + "WHERE geo_id = 'country/USA' AND att.unit = 'Level' AND REPORT = 'JOLTS' AND FREQUENCY = 'Annual'")
-    return cur.fetch_pandas_all()
-
-@st.cache_resource
-def get_min_and_max_date_in_data(name):
-    if name == "employment":
-        table =  "BLS_EMPLOYMENT_TIMESERIES"
-    elif name == "price":
-        table =  "BLS_PRICE_TIMESERIES"
-
-    d = cur.execute(f"select min(DATE), max(DATE) FROM {table}").fetchone()
-
-    return d[0], d[1]
-
-us_anual_cpi_df = load_us_annual_cpi_data()
-us_anual_cpi_df['YEAR'] = pd.DatetimeIndex(us_anual_cpi_df['DATE']).year
-us_anual_cpi_df= us_anual_cpi_df.sort_values(by=['YEAR'])
-
-food_df = build_category_cpi_df(us_anual_cpi_df, 'FOOD', 'CPI:_Food,_Not_seasonally_adjusted,_Annual')
-all_items_df = build_category_cpi_df(us_anual_cpi_df, 'ALL ITEMS', 'CPI:_All_items,_Not_seasonally_adjusted,_Annual')
-energy_df = build_category_cpi_df(us_anual_cpi_df, 'ENERGY', 'CPI:_Energy,_Not_seasonally_adjusted,_Annual')
-all_items_less_food_and_energy_df = build_category_cpi_df(us_anual_cpi_df, 'ALL ITEMS LESS FOOD AND ENERGY', 'CPI:_All_items_less_food_and_energy,_Not_seasonally_adjusted,_Annual')
-
-main_categories_cpi_df = pd.merge(left=all_items_df, right=food_df, how='outer', left_index=True, right_index=True)
-main_categories_cpi_df = main_categories_cpi_df.merge(energy_df, how='outer', left_index=True, right_index=True)
-main_categories_cpi_df = main_categories_cpi_df.merge(all_items_less_food_and_energy_df, how='outer', left_index=True, right_index=True)
-
+# Everything that doesn't need data is rendered first, with placeholders that are filled
+# as the data of each section arrives.
 with st.container():
     st.header('Consumer Price Index (CPI)')
     st.text('CPI is a measure of the average change over time in the prices paid by urban consumers for a market basket of consumer goods and services.')
-    min_date, max_date = get_min_and_max_date_in_data('price')
-    st.text(f'The current data is from {min_date} to {max_date}.')
+    cpi_dates = st.empty()
     st.write('This chart bellow shows the CPI changes through out years.')
-    col1, col2 = st.columns([3, 1])
-
-    end_year = int(main_categories_cpi_df.index.max())
-    start_year = end_year - 20
-    col1.subheader('Years')
-    selected_range_start, selected_range_end = col1.select_slider('Select a range of years to see how CPI has changed.', options=main_categories_cpi_df.index, value=(start_year, end_year))
-    main_categories_cpi_df = main_categories_cpi_df[main_categories_cpi_df.index >= selected_range_start]
-    main_categories_cpi_df = main_categories_cpi_df[main_categories_cpi_df.index <= selected_range_end]
-    main_categories_cpi_df.index = main_categories_cpi_df.index.astype(str)
-    col1.line_chart(main_categories_cpi_df)
-
-
-    if (col2.checkbox('Show data', key='show_cpi_data')):
-        col2.dataframe(main_categories_cpi_df)
-
-us_employment_df = load_us_employment_data()
-us_employment_df['YEAR'] = pd.DatetimeIndex(us_employment_df['DATE']).year
-
-def build_employment_dataframe(key, measure):
-    df = us_employment_df[us_employment_df['MEASURE'] == measure]
-    df = df.groupby('YEAR', as_index = False)['VALUE'].sum()
-    df[key] = df['VALUE']
-    df = df.filter(items=['YEAR', key])
-    df.set_index('YEAR', inplace=True)
-
-    return df
-
-
-layoffs_df = build_employment_dataframe('LAYOFFS', 'Layoffs and discharges')
-hires_df = build_employment_dataframe('HIRES', 'Hires')
-job_openings_df = build_employment_dataframe('JOB OPENINGS', 'Job openings')
-other_separations_df = build_employment_dataframe('OTHER SEPARATIONS', 'Other separations')
-quits_df = build_employment_dataframe('QUITS', 'Quits')
-
-employment_df = pd.merge(left=job_openings_df, right=hires_df, how='outer', left_index=True, right_index=True)
-employment_df = employment_df.merge(quits_df, how='outer', left_index=True, right_index=True)
-employment_df = employment_df.merge(layoffs_df, how='outer', left_index=True, right_index=True)
-employment_df = employment_df.merge(other_separations_df, how='outer', left_index=True, right_index=True)
+    cpi_col1, cpi_col2 = st.columns([3, 1])
+    cpi_col1.subheader('Years')
+    cpi_range = cpi_col1.empty()
+    cpi_chart = cpi_col1.empty()
+    cpi_chart.text('Loading...')
+    show_cpi_data = cpi_col2.checkbox('Show data', key='show_cpi_data')
+    cpi_data = cpi_col2.empty()
 
 with st.container():
     st.header('Job Openings and Labor Turnover Survey (JOLTS)')
     st.text('JOLTS provides data on job openings, hires, and separations at the national and state level. The job openings rate can help measure the tightness of job markets.')
-    min_date, max_date = get_min_and_max_date_in_data('employment')
-    st.text(f'The current data is from {min_date} to {max_date}.')
+    jolts_dates = st.empty()
     st.markdown('* Job Openings: All positions that are open (not filled) on the last business day of the month.')
     st.markdown('* Hires: All additions to the payroll during the month.')
     st.markdown('* Quits: Employees who left voluntarily. Exception: retirements or transfers to other locations are reported with Other Separations.')
@@ -113,9 +42,96 @@ with st.container():
 
     st.write('This chart bellow shows changes in the number of Job Openings, Hires, Quits, Layoff & Discharges, and Other Separations.')
 
-    col1, col2 = st.columns([3, 1])
-
-    col1.line_chart(employment_df)
-    if (col2.checkbox('Show data', key='show_jolts_data')):
-        col2.dataframe(employment_df)
-    
\ No newline at end of file
+    jolts_col1, jolts_col2 = st.columns([3, 1])
+    jolts_chart = jolts_col1.empty()
+    jolts_chart.text('Loading...')
+    show_jolts_data = jolts_col2.checkbox('Show data', key='show_jolts_data')
+    jolts_data = jolts_col2.empty()
+
+def show_dates(placeholder, dates):
+    min_date, max_date = dates['MIN_DATE'], dates['MAX_DATE']
+    placeholder.text(f'The current data is from {min_date} to {max_date}.')
+
+# The charts get every series downsampled to at most CHART_POINTS points over the selected range,
+# in long format, since downsampled series don't keep the same years.
+line_chart = {
+    "mark": "line",
+    "encoding": {
+        "x": {"field": "YEAR", "type": "quantitative", "axis": {"format": "d"}, "scale": {"zero": False}},
+        "y": {"field": "VALUE", "type": "quantitative"},
+        "color": {"field": "SERIES", "type": "nominal", "title": None}
+    }
+}
+
+# The year slider only slices the stored series
+def show_cpi():
+    years, _ = series_store.slice(next(iter(US_CPI_SERIES.values())))
+    end_year = int(years[-1])
+    start_year = end_year - 20
+    selected_range_start, selected_range_end = cpi_range.select_slider('Select a range of years to see how CPI has changed.', options=years.tolist(), value=(start_year, end_year))
+    with page_metrics.stage('transform'):
+        chart_df = series_store.long_frame(US_CPI_SERIES, selected_range_start, selected_range_end, date_column='YEAR')
+    with page_metrics.stage('chart'):
+        cpi_chart.vega_lite_chart(chart_df, line_chart, use_container_width=True)
+
+    if (show_cpi_data):
+        main_categories_cpi_df = series_store.frame(US_CPI_SERIES, selected_range_start, selected_range_end).rename_axis('YEAR')
+        main_categories_cpi_df.index = main_categories_cpi_df.index.astype(str)
+        cpi_data.dataframe(main_categories_cpi_df)
+
+def show_jolts():
+    with page_metrics.stage('transform'):
+        chart_df = series_store.long_frame(US_JOLTS_SERIES, date_column='YEAR')
+    with page_metrics.stage('chart'):
+        jolts_chart.vega_lite_chart(chart_df, line_chart, use_container_width=True)
+    if (show_jolts_data):
+        jolts_data.dataframe(series_store.frame(US_JOLTS_SERIES).rename_axis('YEAR'))
+
+# The series are loaded in the shared series store, from the tables materialized by precompute.py when
+# they exist and are not older than the latest release. The queries of the page don't depend on each
+# other, so they all run in parallel.
+series_store = get_series_store()
+cpi_tables = get_query_tables(us_annual_cpi_query().sql)
+jolts_tables = get_query_tables(us_employment_query().sql)
+with page_metrics.stage('query'):
+    dates = check_freshness()
+    show_dates(cpi_dates, dates.loc['BLS_PRICE_TIMESERIES'])
+    show_dates(jolts_dates, dates.loc['BLS_EMPLOYMENT_TIMESERIES'])
+
+    queries = {}
+    cpi_loaded = series_store.has(US_CPI_SERIES.values())
+    if (not cpi_loaded):
+        main_categories_cpi_df = load_materialized('us_cpi', dates['MAX_DATE'])
+        if (main_categories_cpi_df is None):
+            queries['us_annual_cpi'] = us_annual_cpi_query()
+        else:
+            series_store.put_frame(main_categories_cpi_df, US_CPI_SERIES, tables=cpi_tables)
+            cpi_loaded = True
+    jolts_loaded = series_store.has(US_JOLTS_SERIES.values())
+    if (not jolts_loaded):
+        employment_df = load_materialized('us_jolts', dates['MAX_DATE'])
+        if (employment_df is None):
+            queries['us_employment'] = us_employment_query()
+        else:
+            series_store.put_frame(employment_df, US_JOLTS_SERIES, tables=jolts_tables)
+            jolts_loaded = True
+    futures = dict(zip(submit_queries(queries.values()), queries.keys()))
+
+if (cpi_loaded):
+    show_cpi()
+if (jolts_loaded):
+    show_jolts()
+
+for future in as_completed(futures):
+    name = futures[future]
+    if (name == 'us_annual_cpi'):
+        with page_metrics.stage('transform'):
+            series_store.put_frame(build_us_cpi_df(future.result()), US_CPI_SERIES, tables=cpi_tables)
+        show_cpi()
+    elif (name == 'us_employment'):
+        with page_metrics.stage('transform'):
+            series_store.put_frame(build_us_jolts_df(future.result()), US_JOLTS_SERIES, tables=jolts_tables)
+        show_jolts()
+
+page_metrics.finish()
+start_cache_warmer()
@@ -0,0 +1,205 @@
+# Time the transforms of every page on synthetic BLS shaped data, without a database:
+#
+#     python benchmark.py [--scales 1 10 100] [--repeat 5]
+#
+# The synthetic tables can also be written as Parquet files for the local DuckDB backend,
+# to run the whole app offline:
+#
+#     python benchmark.py --write-tables data --scales 1
+import argparse
+import os
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from functions import (build_state_jolts_table, build_us_cpi_df, build_us_jolts_df, build_wide_df, compact_df,
+    compute_cpi_changes, get_cpi_window_start, prepare_state_jolts_df, US_CPI_LABELS)
+
+CPI_PRODUCTS = ['All items', 'Food', 'Energy', 'All items less food and energy']
+JOLTS_MEASURES = ['Hires', 'Job openings', 'Layoffs and discharges', 'Quits', 'Total separations', 'Other separations']
+METRO_AREAS = ['Dallas-Fort Worth-Arlington, TX Metro Area', 'New York-Newark-Jersey City, NY-NJ-PA Metro Area']
+STATE_FIPS = [1, 2, 4, 5, 6, 8, 9, 10, 11, 12, 13, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32,
+    33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 44, 45, 46, 47, 48, 49, 50, 51, 53, 54, 55, 56]
+
+# Series per table at 1x, which is roughly the size of the data the app reads today. The JOLTS states past
+# the real ones get made up FIPS codes.
+CPI_PRODUCTS_1X = 50
+CPI_AREAS_1X = 4
+JOLTS_INDUSTRIES = 10
+JOLTS_STATES_1X = len(STATE_FIPS)
+SAE_METRO_AREAS_1X = 40
+SAE_INDUSTRIES = 20
+
+def cross(**columns):
+    index = pd.MultiIndex.from_product(list(columns.values()), names=list(columns.keys()))
+    return index.to_frame(index=False)
+
+def random_walk(rng, series, length, start = 100.0):
+    steps = rng.normal(0.002, 0.005, size=(series, length))
+    return (start * np.cumprod(1 + steps, axis=1)).ravel()
+
+# BLS_GEO_INDEX, BLS_PRICE_ATTRIBUTES, BLS_PRICE_TIMESERIES, BLS_EMPLOYMENT_ATTRIBUTES and BLS_EMPLOYMENT_TIMESERIES
+# shaped frames, with scale times the number of CPI products and areas, JOLTS states and metro areas of 1x.
+def generate_bls_tables(scale = 1, seed = 0):
+    rng = np.random.default_rng(seed)
+    months = pd.date_range('1995-01-01', '2024-12-01', freq='MS')
+    years = pd.date_range('1995-01-01', '2024-01-01', freq='YS')
+
+    state_fips = STATE_FIPS + list(range(100, 100 + JOLTS_STATES_1X * scale - len(STATE_FIPS)))
+    metro_areas = METRO_AREAS + [f'Metro {i}, TX Metro Area' for i in range(SAE_METRO_AREAS_1X * scale - len(METRO_AREAS))]
+    geo_df = pd.concat([
+        pd.DataFrame({'ID': ['country/USA'], 'GEO_NAME': ['United States'], 'LEVEL': ['Country']}),
+        pd.DataFrame({'ID': [f'geoId/{fips:02d}' for fips in state_fips], 'GEO_NAME': [f'State {fips:02d}' for fips in state_fips], 'LEVEL': 'State'}),
+        pd.DataFrame({'ID': [f'geoId/C{i}' for i in range(len(metro_areas))], 'GEO_NAME': metro_areas, 'LEVEL': 'CensusCoreBasedStatisticalArea'}),
+    ], ignore_index=True)
+
+    products = CPI_PRODUCTS + [f'Product {i}' for i in range(CPI_PRODUCTS_1X * scale - len(CPI_PRODUCTS))]
+    price_att_df = cross(PRODUCT=products, FREQUENCY=['Monthly', 'Annual'])
+    price_att_df['VARIABLE'] = 'CPI:_' + price_att_df['PRODUCT'].str.replace(' ', '_') + ',_Not_seasonally_adjusted,_' + price_att_df['FREQUENCY']
+    price_att_df['VARIABLE_NAME'] = price_att_df['VARIABLE'].str.replace('_', ' ')
+    price_att_df['REPORT'] = 'Consumer Price Index'
+    price_att_df['SEASONALLY_ADJUSTED'] = False
+
+    # The main categories are published for every area, the other products only for the US
+    cpi_geos = ['country/USA'] + list(geo_df['ID'][1:1 + CPI_AREAS_1X * scale])
+    main_products = tuple(f"CPI:_{product.replace(' ', '_')}," for product in CPI_PRODUCTS)
+    price_ts_dfs = []
+    for frequency, dates in [('Monthly', months), ('Annual', years)]:
+        variables = price_att_df.loc[price_att_df['FREQUENCY'] == frequency, 'VARIABLE']
+        main = variables.str.startswith(main_products)
+        for geos, geo_variables in [(cpi_geos, variables[main]), (['country/USA'], variables[~main])]:
+            df = cross(GEO_ID=geos, VARIABLE=geo_variables, DATE=dates.date)
+            df['VALUE'] = random_walk(rng, len(geos) * len(geo_variables), len(dates))
+            price_ts_dfs.append(df)
+    price_ts_df = pd.concat(price_ts_dfs, ignore_index=True)
+    price_ts_df['VARIABLE_NAME'] = price_ts_df['VARIABLE'].map(price_att_df.set_index('VARIABLE')['VARIABLE_NAME'])
+
+    jolts_industries = ['Total nonfarm'] + [f'Industry {i}' for i in range(JOLTS_INDUSTRIES - 1)]
+    jolts_att_df = cross(MEASURE=JOLTS_MEASURES, INDUSTRY=jolts_industries)
+    jolts_att_df['VARIABLE'] = 'JOLTS_' + jolts_att_df['MEASURE'].str.replace(' ', '_') + '_' + jolts_att_df['INDUSTRY'].str.replace(' ', '_')
+    jolts_att_df = jolts_att_df.assign(UNIT='Level', REPORT='JOLTS', FREQUENCY='Annual', SEASONALLY_ADJUSTED=False)
+
+    sae_industries = ['Financial Activities', 'Government', 'Information'] + [f'Sector {i}' for i in range(SAE_INDUSTRIES - 3)]
+    sae_att_df = pd.DataFrame({'INDUSTRY': sae_industries, 'MEASURE': 'All Employees', 'UNIT': 'Level',
+        'REPORT': 'State and Metro Employment', 'FREQUENCY': 'Monthly', 'SEASONALLY_ADJUSTED': False})
+    sae_att_df['VARIABLE'] = 'SMU_' + sae_att_df['INDUSTRY'].str.replace(' ', '_')
+    employment_att_df = pd.concat([jolts_att_df, sae_att_df], ignore_index=True)
+
+    jolts_geos = geo_df.loc[geo_df['LEVEL'] != 'CensusCoreBasedStatisticalArea', 'ID']
+    jolts_ts_df = cross(GEO_ID=jolts_geos, VARIABLE=jolts_att_df['VARIABLE'], DATE=years.date)
+    jolts_ts_df['VALUE'] = rng.integers(100, 5000, size=len(jolts_ts_df)).astype(float)
+    sae_geos = geo_df.loc[geo_df['LEVEL'] == 'CensusCoreBasedStatisticalArea', 'ID']
+    sae_ts_df = cross(GEO_ID=sae_geos, VARIABLE=sae_att_df['VARIABLE'], DATE=months[-24:].date)
+    sae_ts_df['VALUE'] = rng.integers(100, 5000, size=len(sae_ts_df)).astype(float)
+    employment_ts_df = pd.concat([jolts_ts_df, sae_ts_df], ignore_index=True)
+
+    return {
+        'BLS_GEO_INDEX': geo_df,
+        'BLS_PRICE_ATTRIBUTES': price_att_df,
+        'BLS_PRICE_TIMESERIES': price_ts_df,
+        'BLS_EMPLOYMENT_ATTRIBUTES': employment_att_df,
+        'BLS_EMPLOYMENT_TIMESERIES': employment_ts_df,
+    }
+
+def join_attributes(ts_df, attributes_df, columns):
+    attributes = attributes_df.set_index('VARIABLE')
+    return ts_df.assign(**{column: ts_df['VARIABLE'].map(attributes[column]) for column in columns})
+
+def join_geo(ts_df, geo_df):
+    geo = geo_df.set_index('ID')
+    return ts_df.assign(ID=ts_df['GEO_ID'], GEO_NAME=ts_df['GEO_ID'].map(geo['GEO_NAME']), LEVEL=ts_df['GEO_ID'].map(geo['LEVEL']))
+
+# The result sets the pages receive from their queries, derived from the tables with pandas.
+def build_query_results(tables):
+    price_ts_df = tables['BLS_PRICE_TIMESERIES']
+    employment_ts_df = join_attributes(tables['BLS_EMPLOYMENT_TIMESERIES'], tables['BLS_EMPLOYMENT_ATTRIBUTES'], ['MEASURE', 'INDUSTRY', 'REPORT'])
+    employment_ts_df = join_geo(employment_ts_df, tables['BLS_GEO_INDEX'])
+
+    us_annual_cpi_df = price_ts_df[(price_ts_df['GEO_ID'] == 'country/USA') & price_ts_df['VARIABLE'].str.endswith('_Not_seasonally_adjusted,_Annual')]
+
+    all_monthly_cpi_df = price_ts_df[price_ts_df['VARIABLE'].str.endswith('_Not_seasonally_adjusted,_Monthly')]
+    monthly_cpi_df = price_ts_df[price_ts_df['VARIABLE'].isin([f"CPI:_{product.replace(' ', '_')},_Not_seasonally_adjusted,_Monthly" for product in CPI_PRODUCTS])]
+    monthly_cpi_df = join_geo(join_attributes(monthly_cpi_df, tables['BLS_PRICE_ATTRIBUTES'], ['PRODUCT']), tables['BLS_GEO_INDEX'])
+
+    jolts_df = employment_ts_df[employment_ts_df['REPORT'] == 'JOLTS']
+    us_jolts_df = jolts_df[jolts_df['GEO_ID'] == 'country/USA'].groupby(['DATE', 'MEASURE'], as_index=False)['VALUE'].sum()
+    state_jolts_df = jolts_df[jolts_df['LEVEL'] == 'State'].groupby(['DATE', 'MEASURE', 'ID', 'GEO_NAME'], as_index=False)['VALUE'].mean()
+
+    metro_df = employment_ts_df[(employment_ts_df['REPORT'] == 'State and Metro Employment') & employment_ts_df['INDUSTRY'].isin(['Financial Activities', 'Government', 'Information'])]
+    metro_df = metro_df[metro_df['DATE'] >= metro_df['DATE'].max().replace(year=metro_df['DATE'].max().year - 1)]
+
+    return {
+        'us_annual_cpi': compact_df(us_annual_cpi_df, ['VARIABLE', 'VARIABLE_NAME', 'VALUE', 'DATE']),
+        'monthly_cpi': compact_df(monthly_cpi_df, ['GEO_ID', 'GEO_NAME', 'VARIABLE', 'VARIABLE_NAME', 'PRODUCT', 'VALUE', 'LEVEL', 'DATE']),
+        'all_monthly_cpi': compact_df(all_monthly_cpi_df, ['GEO_ID', 'VARIABLE', 'VALUE', 'DATE']),
+        'us_jolts': compact_df(us_jolts_df),
+        'state_jolts': compact_df(state_jolts_df),
+        'metro_employment': compact_df(metro_df, ['GEO_NAME', 'INDUSTRY', 'DATE', 'VALUE']),
+    }
+
+def run_cpi_page(df):
+    df = df[pd.DatetimeIndex(df['DATE']) >= get_cpi_window_start(df['DATE'].max())]
+    df = df.assign(MONTH=pd.DatetimeIndex(df['DATE']).strftime('%Y-%m'))
+    df = df[df['GEO_ID'] == 'country/USA']
+    df = compute_cpi_changes(df)
+    labels = {variable.replace('_Annual', '_Monthly'): label for variable, label in US_CPI_LABELS.items()}
+    wide_df = build_wide_df(df, 'MONTH', 'VARIABLE', labels)
+    percentage_df = build_wide_df(df, 'MONTH', 'VARIABLE', {variable: label + ' PERCENTAGE' for variable, label in labels.items()}, value='PERCENTAGE')
+    return wide_df.join(percentage_df), compact_df(df, ['MONTH', 'PRODUCT', 'VALUE', 'PERCENTAGE'], downcast_floats=True)
+
+def run_jolts_page(df):
+    df = prepare_state_jolts_df(df)
+    return build_state_jolts_table(df, df['YEAR'].max())
+
+def run_metro_page(df):
+    df = df.assign(MONTH=pd.DatetimeIndex(df['DATE']).strftime('%Y-%m'))
+    return [compact_df(df[df['GEO_NAME'] == area], ['MONTH', 'INDUSTRY', 'VALUE'], downcast_floats=True) for area in METRO_AREAS]
+
+BENCHMARKS = {
+    'Home: US CPI wide frame': (build_us_cpi_df, 'us_annual_cpi'),
+    'Home: US JOLTS wide frame': (build_us_jolts_df, 'us_jolts'),
+    'CPI: period changes and wide frames': (run_cpi_page, 'monthly_cpi'),
+    'CPI: changes of all monthly series': (compute_cpi_changes, 'all_monthly_cpi'),
+    'JOLTS: state table of a year': (run_jolts_page, 'state_jolts'),
+    'Metro: per area chart frames': (run_metro_page, 'metro_employment'),
+}
+
+# Median wall time over repeat runs, and the peak memory allocated by one more traced run.
+def measure(function, df, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(df)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return float(np.median(times)), peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the page transforms on synthetic BLS data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help='sizes of the data relative to today (default: 1 10 100)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark (default: 5)')
+    parser.add_argument('--write-tables', metavar='DIR', help='write the synthetic tables of the first scale as Parquet files to DIR and exit')
+    args = parser.parse_args()
+
+    if (args.write_tables):
+        os.makedirs(args.write_tables, exist_ok=True)
+        for name, df in generate_bls_tables(args.scales[0]).items():
+            df.to_parquet(os.path.join(args.write_tables, f'{name}.parquet'), index=False)
+        print(f'Wrote the {args.scales[0]}x tables to {args.write_tables}')
+        return
+
+    print(f"{'benchmark':<40}{'scale':>7}{'rows':>10}{'time (ms)':>12}{'peak (MiB)':>12}")
+    for scale in args.scales:
+        results = build_query_results(generate_bls_tables(scale))
+        for name, (function, result) in BENCHMARKS.items():
+            seconds, peak = measure(function, results[result], args.repeat)
+            print(f'{name:<40}{scale:>6}x{len(results[result]):>10}{seconds * 1000:>12.2f}{peak / 2 ** 20:>12.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,1175 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import datetime
+import queue
+import threading
 import streamlit as st
 import snowflake.connector
+import pandas as pd
+import numpy as np
 
-@st.cache_resource
-def init_connection():
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pandas.api.types import union_categoricals
+from streamlit import runtime
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.snapshots')
+# Ready to render tables written by precompute.py
+MATERIALIZED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.materialized')
+# Time to live of cached query results in seconds, and the memory budget of the result cache in bytes
+DEFAULT_TTL = 6 * 60 * 60
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Maximum number of open database connections, which is also the number of queries fetched in parallel
+POOL_SIZE = 4
+# Seconds to wait for a free connection when all of them are in use
+POOL_TIMEOUT = 60
+# Query and page render metrics are appended to this file as JSON lines, and the latest ones are kept in memory
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.jsonl')
+RECENT_METRICS = 1000
+# Time to live of the freshness probe, so new data releases are picked up within this many seconds
+FRESHNESS_TTL = 5 * 60
+# Tables probed for new data releases
+TIMESERIES_TABLES = ['BLS_PRICE_TIMESERIES', 'BLS_EMPLOYMENT_TIMESERIES']
+# Points per series sent to a line chart, about one per two pixels of a wide chart, and the number
+# of downsampled series kept by the series store
+CHART_POINTS = 500
+DOWNSAMPLED_SERIES = 256
+# Number of rows per Arrow batch when streaming a result from the local engine
+STREAM_BATCH_ROWS = 100000
+# Largest raw result in bytes a streamed query may fetch
+STREAM_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# A query to run through query_df. params are bound client side with the pyformat style (%(name)s),
+# and snapshot is the name of the local Parquet snapshot the result is kept in, if any.
+Query = namedtuple('Query', ['sql', 'params', 'ttl', 'snapshot'], defaults=[None, DEFAULT_TTL, None])
+
+def init_snowflake_connection():
     return snowflake.connector.connect(
         **st.secrets["snowflake"], client_session_keep_alive=True
     )
 
-def build_category_cpi_df(cpi_df, key, variable, filterByYear = True, filterByMonth = False):
-    df = cpi_df[cpi_df['VARIABLE'] == variable];
-    df[key] = df['VALUE']
+# Serve the queries from a local DuckDB engine when a [local] section is configured in secrets.toml,
+# optionally sending the queries on tables that are not available locally to Snowflake.
+def init_connection():
+    if ('local' in st.secrets):
+        fallback = init_snowflake_connection if st.secrets['local'].get('fallback_to_snowflake', False) else None
+        return LocalConnection(st.secrets['local']['data_dir'], fallback)
+
+    return init_snowflake_connection()
+
+# Hands out connections created by factory, at most size of them, to one caller at a time, so concurrent
+# sessions each get their own cursor instead of sharing the cursor of a single connection.
+class ConnectionPool:
+    def __init__(self, factory, size = POOL_SIZE, timeout = POOL_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._factory = factory
+        # Idle connections, and a None for every connection that was discarded, to wake up a waiting caller
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    # The connection goes back to the pool when the block succeeds. It is closed when the block fails, as it
+    # may be broken or left with an unfinished result, and a new one is created in its place when needed.
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        succeeded = False
+        try:
+            yield conn
+            succeeded = True
+        finally:
+            if (succeeded):
+                self._idle.put(conn)
+            else:
+                self._discard(conn)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        while (True):
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            if (conn is not None):
+                return conn
+
+            with self._lock:
+                create = self._created < self.size
+                if (create):
+                    self._created += 1
+
+            if (create):
+                try:
+                    return self._factory()
+                except Exception:
+                    self._release()
+                    raise
+
+            try:
+                conn = self._idle.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise TimeoutError(f'No database connection was free within {self.timeout} seconds') from None
+            if (conn is not None):
+                return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._created -= 1
+        self._idle.put(None)
+
+@st.cache_resource
+def get_connection_pool():
+    return ConnectionPool(init_connection)
+
+@st.cache_resource
+def get_query_executor():
+    return ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='query')
+
+# Minimal stand-in for a Snowflake connection backed by an embedded DuckDB database where every
+# <TABLE_NAME>.parquet file in data_dir is exposed as a view, with and without the cybersyn schema.
+class LocalConnection:
+    def __init__(self, data_dir, fallback = None):
+        import duckdb
+
+        self._con = duckdb.connect()
+        self._fallback = fallback
+        self._fallback_connection = None
+        self._con.execute("CREATE SCHEMA IF NOT EXISTS cybersyn")
+        for path in sorted(glob.glob(os.path.join(data_dir, '*.parquet'))):
+            table = os.path.splitext(os.path.basename(path))[0].upper()
+            for schema in ['main', 'cybersyn']:
+                self._con.execute(f"CREATE OR REPLACE VIEW {schema}.{table} AS SELECT * FROM read_parquet('{path}')")
+
+    def cursor(self):
+        return LocalCursor(self._con.cursor(), self._get_fallback_connection if self._fallback else None)
+
+    def close(self):
+        self._con.close()
+        if (self._fallback_connection is not None):
+            self._fallback_connection.close()
+
+    def _get_fallback_connection(self):
+        if (self._fallback_connection is None):
+            self._fallback_connection = self._fallback()
+        return self._fallback_connection
+
+class LocalCursor:
+    def __init__(self, con, fallback = None):
+        self._con = con
+        self._fallback = fallback
+        self._delegate = None
+
+    def execute(self, sql, params = None):
+        import duckdb
+
+        self._delegate = None
+        try:
+            self._con.execute(bind_params(sql, params))
+        except duckdb.CatalogException:
+            if (self._fallback is None):
+                raise
+            self._delegate = self._fallback().cursor()
+            self._delegate.execute(sql, params)
+
+        return self
+
+    def fetchone(self):
+        if (self._delegate is not None):
+            return self._delegate.fetchone()
+        return self._con.fetchone()
+
+    def fetch_pandas_all(self):
+        if (self._delegate is not None):
+            return self._delegate.fetch_pandas_all()
+        return self._con.df()
+
+    def fetch_arrow_all(self):
+        if (self._delegate is not None):
+            return self._delegate.fetch_arrow_all()
+        return self._con.arrow()
+
+    def fetch_arrow_batches(self):
+        if (self._delegate is not None):
+            return self._delegate.fetch_arrow_batches()
+        return iter(self._con.fetch_record_batch(STREAM_BATCH_ROWS))
+
+    def close(self):
+        if (self._delegate is not None):
+            self._delegate.close()
+        self._con.close()
+
+# Pivot the rows of a long frame for the given variables/measures into one wide frame indexed by index,
+# in a single pass. labels maps each value of column to the name of its column in the wide frame.
+def build_wide_df(df, index, column, labels, value = 'VALUE', aggfunc = 'first'):
+    df = df[df[column].isin(list(labels.keys()))]
+    wide_df = df.pivot_table(index=index, columns=column, values=value, aggfunc=aggfunc, observed=True)
+    wide_df = wide_df.reindex(columns=list(labels.keys())).rename(columns=labels)
+    wide_df.columns.name = None
+
+    return wide_df
+
+# Assemble a SELECT statement from its clauses. With group_by and aggregates the reduction runs in the
+# warehouse and only one row per group is transferred, e.g. aggregates={'VALUE': 'SUM(TS.VALUE)'}.
+def build_query(table, columns = (), joins = (), where = (), group_by = (), aggregates = None, order_by = ()):
+    aggregates = aggregates or {}
+    select = list(columns) + list(group_by) + [f'{expression} AS {alias}' for alias, expression in aggregates.items()]
+    sql = f"SELECT {', '.join(select)} FROM {table}"
+
+    for join in joins:
+        sql += f" JOIN {join}"
+    if (where):
+        sql += " WHERE " + " AND ".join(where)
+    if (group_by):
+        sql += " GROUP BY " + ", ".join(group_by)
+    if (order_by):
+        sql += " ORDER BY " + ", ".join(order_by)
+
+    return sql
+
+def get_snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIR, f'{name}.parquet')
+
+# Keep the result of a query as a Parquet file on local disk and only fetch the rows
+# newer than the latest stored date on refresh, instead of pulling the whole result again.
+def load_snapshot(cur, name, sql, params = None, date_column = 'DATE'):
+    sql, stored_df = prepare_snapshot(name, sql, date_column)
+    cur.execute(sql, params)
+    return save_snapshot(name, stored_df, cur.fetch_pandas_all())
+
+# The query fetching what is missing from the snapshot, along with the stored rows.
+def prepare_snapshot(name, sql, date_column = 'DATE'):
+    path = get_snapshot_path(name)
+    stored_df = pd.read_parquet(path) if os.path.exists(path) else None
+
+    if (stored_df is None or stored_df.empty):
+        return sql, None
+
+    max_date = stored_df[date_column].max()
+    return f"SELECT * FROM ({sql}) AS snapshot WHERE {date_column} > '{max_date}'", stored_df
+
+def save_snapshot(name, stored_df, new_df):
+    if (stored_df is not None):
+        if (new_df.empty):
+            return stored_df
+        new_df = pd.concat([stored_df, new_df], ignore_index=True)
+
+    path = get_snapshot_path(name)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    new_df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    return new_df
+
+# Writes a snapshot one Arrow batch at a time after the stored rows, so a large result is never held in memory as
+# a whole. The snapshot is only replaced on close, once all the rows were written, and left as it was on abort.
+class SnapshotWriter:
+    def __init__(self, name, stored_df):
+        self.name = name
+        self._stored_df = stored_df
+        self._writer = None
+        self._tmp_path = None
+
+    def write(self, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if (batch.num_rows == 0):
+            return
+
+        table = pa.Table.from_batches([batch]) if isinstance(batch, pa.RecordBatch) else batch
+        if (self._writer is None):
+            stored = pa.Table.from_pandas(self._stored_df, preserve_index=False) if self._stored_df is not None else None
+            # The integer width of a column can change from one batch of the Snowflake connector to the next
+            schema = (stored if stored is not None else table).schema
+            schema = pa.schema([field.with_type(pa.int64()) if pa.types.is_integer(field.type) else field for field in schema])
+
+            path = get_snapshot_path(self.name)
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            self._tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            self._writer = pq.ParquetWriter(self._tmp_path, schema)
+            if (stored is not None):
+                self._writer.write_table(stored.cast(schema))
+
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def close(self):
+        if (self._writer is not None):
+            self._writer.close()
+            self._writer = None
+            os.replace(self._tmp_path, get_snapshot_path(self.name))
+
+    def abort(self):
+        if (self._writer is not None):
+            self._writer.close()
+            self._writer = None
+            os.remove(self._tmp_path)
+
+# Same client side binding of pyformat parameters as the Snowflake connector, where a list is
+# rendered as comma separated values, e.g. "IN (%(industries)s)".
+def bind_params(sql, params):
+    if (not params):
+        return sql
+
+    def quote(value):
+        if (isinstance(value, (list, tuple))):
+            return ', '.join(quote(v) for v in value)
+        if (value is None):
+            return 'NULL'
+        if (isinstance(value, bool)):
+            return 'TRUE' if value else 'FALSE'
+        if (isinstance(value, (int, float))):
+            return repr(value)
+        # A plain string would be cast to the type of the column it is compared with, which truncates a timestamp
+        if (isinstance(value, datetime.datetime)):
+            return "TIMESTAMP '" + value.isoformat(' ') + "'"
+        if (isinstance(value, datetime.date)):
+            return "DATE '" + value.isoformat() + "'"
+        return "'" + str(value).replace("'", "''") + "'"
+
+    return sql % {key: quote(value) for key, value in params.items()}
+
+def normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def get_query_key(query):
+    params = tuple(sorted((key, repr(value)) for key, value in query.params.items())) if query.params else ()
+    return (normalize_sql(query.sql), params)
+
+# Names of the tables a query reads, without their schema
+def get_query_tables(sql):
+    return frozenset(name.split('.')[-1].upper() for name in re.findall(r'\b(?:FROM|JOIN)\s+([\w.]+)', sql, flags=re.IGNORECASE))
+
+def get_size(value):
+    if (isinstance(value, pd.DataFrame) and len(value.columns)):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return sys.getsizeof(value)
+
+# Process wide LRU cache of query results with a byte budget and a time to live per entry.
+class ResultCache:
+    def __init__(self, max_bytes = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry['expires_at'] <= time.monotonic()):
+                self._remove(key)
+                entry = None
+
+            if (entry is None):
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry['value']
+
+    # tables are the tables the value was read from, for invalidate_tables
+    def put(self, key, value, ttl = DEFAULT_TTL, tables = ()):
+        size = get_size(value)
+        with self._lock:
+            if (key in self._entries):
+                self._remove(key)
+            if (size > self.max_bytes):
+                return value
+
+            self._entries[key] = {'value': value, 'size': size, 'expires_at': time.monotonic() + ttl, 'tables': frozenset(tables)}
+            self._bytes += size
+            while (self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Drop the entries read from any of the given tables, except the keys in keep.
+    def invalidate_tables(self, tables, keep = ()):
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry['tables'] & set(tables) and key not in keep]
+            for key in keys:
+                self._remove(key)
+
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_ratio': self._hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
+
+# Process wide store of time series keyed by (geo, variable). Each series is held once as two contiguous
+# arrays sorted by date, so a date range is found with two binary searches and is a view of the arrays.
+class SeriesStore:
+    def __init__(self, max_downsampled = DOWNSAMPLED_SERIES):
+        self.max_downsampled = max_downsampled
+        self._series = {}
+        self._downsampled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, dates, values, ttl = DEFAULT_TTL, tables = ()):
+        dates = np.asarray(dates)
+        order = np.argsort(dates, kind='stable')
+        entry = {
+            'dates': np.ascontiguousarray(dates[order]),
+            'values': np.ascontiguousarray(np.asarray(values, dtype='float64')[order]),
+            'expires_at': time.monotonic() + ttl,
+            'tables': frozenset(tables),
+        }
+        with self._lock:
+            self._series[key] = entry
+            self._drop_downsampled([key])
+
+    # Store the columns of a frame indexed by date, keys maps each column to the key of its series.
+    def put_frame(self, df, keys, ttl = DEFAULT_TTL, tables = ()):
+        for column, key in keys.items():
+            self.put(key, df.index.to_numpy(), df[column].to_numpy(), ttl, tables)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._series.get(key)
+            if (entry is not None and entry['expires_at'] <= time.monotonic()):
+                del self._series[key]
+                self._drop_downsampled([key])
+                entry = None
+
+            return entry
+
+    def has(self, keys):
+        return all(self.get(key) is not None for key in keys)
+
+    def remove(self, key):
+        with self._lock:
+            self._series.pop(key, None)
+            self._drop_downsampled([key])
+
+    def invalidate_tables(self, tables):
+        with self._lock:
+            keys = [key for key, entry in self._series.items() if entry['tables'] & set(tables)]
+            for key in keys:
+                del self._series[key]
+            self._drop_downsampled(keys)
+
+        return len(keys)
+
+    def _drop_downsampled(self, keys):
+        for downsampled_key in [k for k in self._downsampled if k[0] in keys]:
+            del self._downsampled[downsampled_key]
+
+    # The dates and values of a series between start and end, both included, as views of the stored arrays.
+    def slice(self, key, start = None, end = None):
+        entry = self.get(key)
+        if (entry is None):
+            raise KeyError(key)
+
+        dates = entry['dates']
+        lo = 0 if start is None else np.searchsorted(dates, start, side='left')
+        hi = len(dates) if end is None else np.searchsorted(dates, end, side='right')
+        return dates[lo:hi], entry['values'][lo:hi]
+
+    # Several series side by side, columns maps each column name to the key of its series.
+    def frame(self, columns, start = None, end = None):
+        series = {}
+        for column, key in columns.items():
+            dates, values = self.slice(key, start, end)
+            series[column] = pd.Series(values, index=dates, copy=False)
+
+        return pd.DataFrame(series)
+
+    # A series between start and end reduced to at most points points with lttb. The reduced
+    # series are cached per range and number of points.
+    def downsample(self, key, start = None, end = None, points = CHART_POINTS):
+        downsampled_key = (key, start, end, points)
+        with self._lock:
+            if (downsampled_key in self._downsampled):
+                self._downsampled.move_to_end(downsampled_key)
+                return self._downsampled[downsampled_key]
+
+        dates, values = self.slice(key, start, end)
+        present = ~np.isnan(values)
+        dates, values = dates[present], values[present]
+        indices = lttb(dates, values, points)
+        downsampled = (dates[indices], values[indices])
+
+        with self._lock:
+            if (key in self._series):
+                self._downsampled[downsampled_key] = downsampled
+                while (len(self._downsampled) > self.max_downsampled):
+                    self._downsampled.popitem(last=False)
+
+        return downsampled
+
+    # Downsampled series in one long frame with a row per point, since the series don't keep the same dates.
+    def long_frame(self, columns, start = None, end = None, points = CHART_POINTS, date_column = 'DATE'):
+        frames = []
+        for column, key in columns.items():
+            dates, values = self.downsample(key, start, end, points)
+            frames.append(pd.DataFrame({date_column: dates, 'SERIES': column, 'VALUE': values}))
+
+        return pd.concat(frames, ignore_index=True)
+
+# Indices of the points kept by the largest triangle three buckets downsampling: the first and last
+# points, and from each bucket in between the point making the largest triangle with the point kept
+# from the previous bucket and the average of the next bucket, which keeps the peaks and troughs.
+def lttb(x, y, points):
+    n = len(x)
+    if (points >= n or points < 3):
+        return np.arange(n)
+
+    if (np.issubdtype(x.dtype, np.datetime64)):
+        x = x.astype('int64')
+    x = x.astype('float64')
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    indices = np.empty(points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        average_x, average_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        areas = np.abs((x[a] - average_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (average_y - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+
+    return indices
 
-    if (filterByYear):
-        df = df.filter(items=[key, 'YEAR'])
-        df.set_index('YEAR', inplace=True)
+@st.cache_resource
+def get_series_store():
+    return SeriesStore()
+
+def elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+# Times a query in three parts: running it in the warehouse, downloading the Arrow result
+# and converting it to pandas, and counts the rows and the Arrow bytes of the result.
+class InstrumentedCursor:
+    def __init__(self, cur):
+        self._cur = cur
+        self.stats = {'execute_ms': 0.0, 'fetch_ms': 0.0, 'convert_ms': 0.0, 'rows': 0, 'arrow_bytes': 0}
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def execute(self, sql, params = None):
+        start = time.perf_counter()
+        self._cur.execute(sql, params)
+        self.stats['execute_ms'] += elapsed_ms(start)
+        return self
+
+    def get_results_from_sfqid(self, query_id):
+        start = time.perf_counter()
+        self._cur.get_results_from_sfqid(query_id)
+        self.stats['execute_ms'] += elapsed_ms(start)
+
+    def fetch_pandas_all(self):
+        start = time.perf_counter()
+        table = self._cur.fetch_arrow_all()
+        self.stats['fetch_ms'] += elapsed_ms(start)
+        # The connector returns no table for an empty result
+        if (table is None):
+            return self._cur.fetch_pandas_all()
+
+        self.stats['rows'] += table.num_rows
+        self.stats['arrow_bytes'] += table.nbytes
+        return self.to_pandas(table)
+
+    def fetch_arrow_batches(self):
+        batches = self._cur.fetch_arrow_batches()
+        while (True):
+            start = time.perf_counter()
+            batch = next(batches, None)
+            self.stats['fetch_ms'] += elapsed_ms(start)
+            if (batch is None):
+                return
+
+            self.stats['rows'] += batch.num_rows
+            self.stats['arrow_bytes'] += batch.nbytes
+            yield batch
+
+    def to_pandas(self, table):
+        start = time.perf_counter()
+        df = table.to_pandas()
+        self.stats['convert_ms'] += elapsed_ms(start)
+        return df
+
+# Keeps the latest metrics in memory for the debug panel and appends every one of them to a JSON lines file.
+class MetricsRecorder:
+    def __init__(self, path = METRICS_FILE, size = RECENT_METRICS):
+        self.path = path
+        self._recent = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, kind, **fields):
+        record = {'kind': kind, 'timestamp': time.time(), **fields}
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._recent.append(record)
+            if (self.path):
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+
+        return record
+
+    def recent(self, kind, since = 0):
+        with self._lock:
+            return [record for record in self._recent if record['kind'] == kind and record['timestamp'] >= since]
+
+    # Render time percentiles per page over the renders kept in memory
+    def render_latency(self, percentiles = (0.5, 0.95)):
+        renders = pd.DataFrame(self.recent('render'), columns=['page', 'total_ms'])
+        return renders.groupby('page')['total_ms'].quantile(list(percentiles)).unstack()
+
+    def record_query(self, query, cache, wall_ms, stats = None):
+        return self.record('query', sql=normalize_sql(query.sql)[:200], snapshot=query.snapshot, cache=cache,
+            wall_ms=round(wall_ms, 3), **{key: round(value, 3) for key, value in (stats or {}).items()})
+
+# Not a cached resource, since the queries are also recorded from the query threads, which don't see those.
+metrics = MetricsRecorder()
+
+# Times the stages of a page run. finish records the time of the whole run and shows the debug panel.
+class PageMetrics:
+    def __init__(self, page):
+        self.page = page
+        self.stages = {}
+        self._start = time.perf_counter()
+        self._started_at = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed_ms(start)
+
+    def finish(self):
+        record = metrics.record('render', page=self.page, total_ms=round(elapsed_ms(self._start), 3),
+            stages={name: round(ms, 3) for name, ms in self.stages.items()})
+        show_debug_panel(record, self._started_at)
+
+def show_debug_panel(render, started_at):
+    if (not st.sidebar.checkbox('Show debug metrics', key='show_debug_metrics')):
+        return
+
+    st.sidebar.subheader('This run (ms)')
+    st.sidebar.dataframe(pd.Series({'total': render['total_ms'], **render['stages']}, name='ms'))
+    st.sidebar.subheader('Queries')
+    queries = pd.DataFrame(metrics.recent('query', started_at))
+    st.sidebar.dataframe(queries.drop(columns=['kind', 'timestamp']) if not queries.empty else queries)
+    st.sidebar.subheader('Result cache')
+    st.sidebar.json(get_result_cache().stats())
+    st.sidebar.subheader('Render latency per page (ms)')
+    st.sidebar.dataframe(metrics.render_latency())
+
+# Run a query through the shared result cache, going to the snapshot store or the database on a miss.
+def query_df(query):
+    return run_query(get_connection_pool(), get_result_cache(), query)
+
+def run_query(pool, cache, query):
+    start = time.perf_counter()
+    df = cache.get(get_query_key(query))
+    if (df is None):
+        df = fetch_query(pool, cache, query)
+    else:
+        metrics.record_query(query, 'hit', elapsed_ms(start))
+
+    return df
+
+def fetch_query(pool, cache, query):
+    return cache.put(get_query_key(query), read_query(pool, query), query.ttl, get_query_tables(query.sql))
+
+# Run a query without going through the result cache, for results that are cached in another shape.
+def read_query(pool, query):
+    start = time.perf_counter()
+    with pool.cursor() as cur:
+        cur = InstrumentedCursor(cur)
+        if (query.snapshot):
+            df = load_snapshot(cur, query.snapshot, query.sql, query.params)
+        else:
+            cur.execute(query.sql, query.params)
+            df = cur.fetch_pandas_all()
+
+    df = compact_df(df)
+    metrics.record_query(query, 'miss', elapsed_ms(start), cur.stats)
+    return df
+
+# Run a query and yield its result one Arrow batch at a time, converted to pandas, passed through reduce
+# and compacted, so only one batch of the raw result is in memory at once instead of the whole result
+# twice, as Arrow and as pandas. Snapshot queries yield the stored rows first, then the new ones.
+def stream_query(pool, query, reduce = None):
+    reduce = reduce or (lambda df: df)
+    start = time.perf_counter()
+    sql, stored_df = prepare_snapshot(query.snapshot, query.sql) if query.snapshot else (query.sql, None)
+    if (stored_df is not None):
+        yield compact_df(reduce(stored_df))
+
+    # The raw rows go to the snapshot batch by batch, on a refresh these are only the rows added since the last one
+    writer = SnapshotWriter(query.snapshot, stored_df) if query.snapshot else None
+    try:
+        with pool.cursor() as cur:
+            cur = InstrumentedCursor(cur)
+            cur.execute(sql, query.params)
+            for batch in cur.fetch_arrow_batches():
+                if (cur.stats['arrow_bytes'] > STREAM_MAX_BYTES):
+                    raise RuntimeError(f'The result of the query is larger than {STREAM_MAX_BYTES} bytes')
+                if (writer):
+                    writer.write(batch)
+                yield compact_df(reduce(cur.to_pandas(batch)))
+
+        if (writer):
+            writer.close()
+    finally:
+        if (writer):
+            writer.abort()
+    metrics.record_query(query, 'miss', elapsed_ms(start), cur.stats)
+
+def query_batches(query, reduce = None):
+    return stream_query(get_connection_pool(), query, reduce)
+
+# Like query_df for the reduced result of a query, which is what gets cached instead of the raw result.
+def query_reduced_df(query, reduce):
+    return run_reduced_query(get_connection_pool(), get_result_cache(), query, reduce)
+
+def run_reduced_query(pool, cache, query, reduce):
+    start = time.perf_counter()
+    key = (reduce.__name__,) + get_query_key(query)
+    df = cache.get(key)
+    if (df is None):
+        df = cache.put(key, concat_batches(stream_query(pool, query, reduce)), query.ttl, get_query_tables(query.sql))
+    else:
+        metrics.record_query(query, 'hit', elapsed_ms(start))
+
+    return df
+
+# Concatenate compacted batches, keeping the string columns categorical: the categories of a column
+# are the union of the categories of the batches, which pd.concat would turn back into strings.
+def concat_batches(dfs):
+    dfs = list(dfs)
+    if (not dfs):
+        return pd.DataFrame()
+
+    for column in dfs[0].columns:
+        if (any(isinstance(df[column].dtype, pd.CategoricalDtype) for df in dfs)):
+            values = [df[column].astype('category') for df in dfs]
+            categories = union_categoricals(values).categories
+            dfs = [df.assign(**{column: value.cat.set_categories(categories)}) for df, value in zip(dfs, values)]
+
+    return pd.concat(dfs, ignore_index=True)
+
+# Start all the queries at once and return a future per query. Cache hits are resolved right away, the
+# other queries are submitted with the connector's execute_async so they run in parallel in the warehouse,
+# and their results are fetched on the query threads. Backends without async execution run on those threads.
+def submit_queries(queries):
+    pool = get_connection_pool()
+    cache = get_result_cache()
+    executor = get_query_executor()
+    futures = []
+
+    # Connections of the Snowflake connector can be shared between threads, only cursors can't,
+    # so the results are fetched with new cursors after the connection went back to the pool.
+    with pool.connection() as conn:
+        for query in queries:
+            start = time.perf_counter()
+            df = cache.get(get_query_key(query))
+            if (df is not None):
+                metrics.record_query(query, 'hit', elapsed_ms(start))
+                future = Future()
+                future.set_result(df)
+            elif (hasattr(conn, 'get_query_status')):
+                sql, stored_df = prepare_snapshot(query.snapshot, query.sql) if query.snapshot else (query.sql, None)
+                cur = conn.cursor()
+                cur.execute_async(sql, query.params)
+                future = executor.submit(collect_query, conn, cur.sfqid, cache, query, stored_df, start)
+                cur.close()
+            else:
+                future = executor.submit(fetch_query, pool, cache, query)
+            futures.append(future)
+
+    return futures
+
+def query_many(queries):
+    return [future.result() for future in submit_queries(queries)]
+
+def collect_query(conn, query_id, cache, query, stored_df, start):
+    cur = InstrumentedCursor(conn.cursor())
+    try:
+        cur.get_results_from_sfqid(query_id)
+        df = cur.fetch_pandas_all()
+    finally:
+        cur.close()
+
+    if (query.snapshot):
+        df = save_snapshot(query.snapshot, stored_df, df)
+
+    df = compact_df(df)
+    metrics.record_query(query, 'miss', elapsed_ms(start), cur.stats)
+    return cache.put(get_query_key(query), df, query.ttl, get_query_tables(query.sql))
+
+# Smaller copy of a frame for the cache and the charts: strings repeated in at least half of the rows
+# become categoricals, integers are downcast, and with columns only those columns are kept. Floats are
+# only downcast with downcast_floats, for frames sent to the charts, since the cached frames are read by
+# transforms and data tables that need the full precision.
+def compact_df(df, columns = None, downcast_floats = False):
+    df = df.filter(items=columns) if columns is not None else df.copy()
+
+    for column in df.columns:
+        values = df[column]
+        if (pd.api.types.is_float_dtype(values)):
+            if (downcast_floats):
+                df[column] = pd.to_numeric(values, downcast='float')
+        elif (pd.api.types.is_integer_dtype(values)):
+            df[column] = pd.to_numeric(values, downcast='integer')
+        elif (values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'string'
+                and values.nunique() <= len(values) / 2):
+            df[column] = values.astype('category')
+
+    return df
+
+# Month over month, year over year and annualized percentage changes of every series in a long CPI frame,
+# where a series is a value of the key columns. The previous values are looked up by period rather than
+# by row, so a missing month gives no change instead of a change from the wrong month. There must be at
+# most one row per series and period.
+def compute_cpi_changes(cpi_df, key = ('GEO_ID', 'VARIABLE'), periods_per_year = 12):
+    key = [key] if isinstance(key, str) else list(key)
+    dates = pd.DatetimeIndex(cpi_df['DATE'])
+    periods = dates.year * periods_per_year + (dates.month - 1) // (12 // periods_per_year)
+    series = [cpi_df[column] for column in key]
+    values = pd.Series(cpi_df['VALUE'].to_numpy(dtype='float64'), index=pd.MultiIndex.from_arrays(series + [periods]))
 
-    if (filterByMonth):
-        df = df.filter(items=[key, 'MONTH'])
-        df.set_index('MONTH', inplace=True)
+    def percentage_change(lag):
+        previous = values.reindex(pd.MultiIndex.from_arrays(series + [periods - lag]))
+        return (values.to_numpy() / previous.to_numpy() - 1) * 100
+
+    percentage = percentage_change(1)
+    return cpi_df.assign(**{
+        'PERCENTAGE': percentage,
+        'YEAR OVER YEAR PERCENTAGE': percentage_change(periods_per_year),
+        'ANNUALIZED PERCENTAGE': ((1 + percentage / 100) ** periods_per_year - 1) * 100,
+    })
+
+US_CPI_LABELS = {
+    'CPI:_All_items,_Not_seasonally_adjusted,_Annual': 'ALL ITEMS',
+    'CPI:_Food,_Not_seasonally_adjusted,_Annual': 'FOOD',
+    'CPI:_Energy,_Not_seasonally_adjusted,_Annual': 'ENERGY',
+    'CPI:_All_items_less_food_and_energy,_Not_seasonally_adjusted,_Annual': 'ALL ITEMS LESS FOOD AND ENERGY',
+}
+
+US_JOLTS_LABELS = {
+    'Job openings': 'JOB OPENINGS',
+    'Hires': 'HIRES',
+    'Quits': 'QUITS',
+    'Layoffs and discharges': 'LAYOFFS',
+    'Other separations': 'OTHER SEPARATIONS',
+}
+
+# Keys of the series store of the columns of the US CPI and JOLTS frames
+US_CPI_SERIES = {label: ('country/USA', variable) for variable, label in US_CPI_LABELS.items()}
+US_JOLTS_SERIES = {label: ('country/USA', measure) for measure, label in US_JOLTS_LABELS.items()}
+
+# The first and latest period of every timeseries table in one query. Snowflake answers MIN and MAX
+# of a column from the metadata of the micro-partitions, without scanning the tables.
+def freshness_query():
+    return Query(" UNION ALL ".join(f"SELECT '{table}' AS TABLE_NAME, MIN(DATE) AS MIN_DATE, MAX(DATE) AS MAX_DATE FROM {table}"
+        for table in TIMESERIES_TABLES), ttl=FRESHNESS_TTL)
+
+# Latest period seen of every probed table, to tell which tables got a new release since the last probe.
+class FreshnessTracker:
+    def __init__(self):
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def update(self, latest):
+        with self._lock:
+            changed = {table for table, date in latest.items() if table in self._latest and self._latest[table] != date}
+            self._latest.update(latest)
+
+        return changed
+
+@st.cache_resource
+def get_freshness_tracker():
+    return FreshnessTracker()
+
+# Probe the timeseries tables and drop the cached results and series read from the tables that have a new
+# release, so they are fetched again while the results of the other tables stay cached. Returns the first
+# and latest date of every table, indexed by table name.
+def check_freshness():
+    return refresh_caches(get_connection_pool(), get_result_cache(), get_series_store(), get_freshness_tracker())
+
+def refresh_caches(pool, cache, store, tracker):
+    query = freshness_query()
+    dates = run_query(pool, cache, query).set_index('TABLE_NAME')
+    changed = tracker.update(dates['MAX_DATE'].to_dict())
+    if (changed):
+        cache.invalidate_tables(changed, keep=[get_query_key(query)])
+        store.invalidate_tables(changed)
+
+    return dates
+
+# The monthly series of the four main CPI categories in every geo. The snapshot keeps their whole history under
+# a fixed name, so a new release only fetches the months after it, and the pages select their window afterwards.
+def monthly_cpi_query():
+    return Query("SELECT GEO_ID,  GEO_NAME, ts.VARIABLE, ts.VARIABLE_NAME, PRODUCT, VALUE, LEVEL, DATE "
+        + "FROM cybersyn.bls_price_timeseries AS ts "
+        + "JOIN cybersyn.bls_price_attributes AS att ON (ts.variable = att.variable) "
+        + "JOIN cybersyn.bls_geo_index AS geo ON (ts.geo_id = geo.id) "
+        + "WHERE att.report = 'Consumer Price Index' "
+        + "AND ts.VARIABLE IN ('CPI:_All_items,_Not_seasonally_adjusted,_Monthly', 'CPI:_Energy,_Not_seasonally_adjusted,_Monthly', 'CPI:_Food,_Not_seasonally_adjusted,_Monthly', 'CPI:_All_items_less_food_and_energy,_Not_seasonally_adjusted,_Monthly') "
+        + "ORDER BY date", snapshot='cpi_monthly')
+
+# First month of the CPI window ending at max_date, 13 months back so the 12 months have a month over month change
+def get_cpi_window_start(max_date):
+    return (pd.Timestamp(max_date) - pd.DateOffset(months=13)).replace(day=1)
+
+def industries_query():
+    return Query("SELECT DISTINCT(INDUSTRY) FROM BLS_EMPLOYMENT_ATTRIBUTES WHERE INDUSTRY NOT LIKE '%:%'")
+
+def metro_areas_query():
+    return Query("SELECT GEO_NAME FROM BLS_GEO_INDEX WHERE LEVEL = 'CensusCoreBasedStatisticalArea' AND GEO_NAME LIKE '%Metro Area'")
+
+def us_annual_cpi_query(): 
+    return Query("SELECT VARIABLE, VARIABLE_NAME, VALUE, DATE FROM BLS_PRICE_TIMESERIES "
+        + "WHERE GEO_ID = 'country/USA' AND VARIABLE LIKE '%_Not_seasonally_adjusted,_Annual%'", snapshot='us_annual_cpi')
+
+def us_employment_query():
+    return Query(build_query('bls_employment_timeseries AS ts',
+        joins=['cybersyn.bls_employment_attributes AS att ON (ts.variable = att.variable)'],
+        where=["ts.geo_id = 'country/USA'", "att.unit = 'Level'", "att.report = 'JOLTS'", "att.frequency = 'Annual'"],
+        group_by=['ts.date', 'att.measure'],
+        aggregates={'VALUE': 'SUM(ts.value)'}), snapshot='us_jolts_by_measure')
+
+def state_employment_query():
+    return Query(build_query('BLS_EMPLOYMENT_TIMESERIES AS TS',
+        joins=['BLS_EMPLOYMENT_ATTRIBUTES AS ATT ON (TS.VARIABLE = ATT.VARIABLE)', 'BLS_GEO_INDEX AS GEO ON (TS.GEO_ID = GEO.ID)'],
+        where=["GEO.LEVEL = 'State'", "ATT.UNIT = 'Level'", "REPORT = 'JOLTS'", "FREQUENCY = 'Annual'"],
+        group_by=['TS.DATE', 'ATT.MEASURE', 'GEO.ID', 'GEO.GEO_NAME'],
+        aggregates={'VALUE': 'AVG(TS.VALUE)'},
+        order_by=['GEO.GEO_NAME', 'TS.DATE']), snapshot='state_jolts_by_measure')
+
+def state_metro_employment_query(industries, areas, min_date):
+    return Query("SELECT geo.geo_name, att.industry, ts.date, ts.value "
+        + "FROM bls_employment_timeseries AS ts "
+        + "JOIN bls_employment_attributes AS att ON (ts.variable = att.variable) "
+        + "JOIN bls_geo_index AS geo ON (ts.geo_id = geo.id) "
+        + "WHERE att.report = 'State and Metro Employment' "
+        + "AND att.industry IN (%(industries)s) "
+        + "AND att.measure = 'All Employees' "
+        + "AND att.frequency = 'Monthly' "
+        + "AND att.seasonally_adjusted = FALSE "
+        + "AND geo.level = 'CensusCoreBasedStatisticalArea' "
+        + "AND geo.geo_name IN (%(areas)s) "
+        + "AND DATE >= %(min_date)s "
+        + "ORDER BY date", {'industries': list(industries), 'areas': list(areas), 'min_date': min_date})
+
+def add_month(df):
+    return df.assign(MONTH=pd.DatetimeIndex(df['DATE']).strftime('%Y-%m'))
+
+# Every (industry, metro area) series is cached on its own, so a change of the selection
+# only fetches the series that were not loaded yet. The cached series are yielded first,
+# then the missing ones batch by batch as they are fetched.
+def stream_state_metro_employment(pool, cache, industries, areas, min_date):
+    series = []
+    missing = set()
+
+    for industry in industries:
+        for area in areas:
+            df = cache.get(('metro_employment', industry, area, min_date))
+            if (df is None):
+                missing.add((industry, area))
+            elif (not df.empty):
+                series.append(df)
+
+    if (series):
+        yield concat_batches(series)
+
+    if (missing):
+        # The query covers every missing industry in every missing area, which can include pairs
+        # that are already cached, so the rows of those pairs are dropped from the batches.
+        query = state_metro_employment_query(sorted({industry for industry, _ in missing}), sorted({area for _, area in missing}), min_date)
+        batches = []
+        for df in stream_query(pool, query, add_month):
+            df = df[pd.MultiIndex.from_arrays([df['INDUSTRY'], df['GEO_NAME']]).isin(missing)]
+            if (not df.empty):
+                batches.append(df)
+                yield df
+
+        df = concat_batches(batches)
+        groups = df.groupby(['INDUSTRY', 'GEO_NAME'], observed=True).indices if not df.empty else {}
+        for industry, area in missing:
+            rows = groups.get((industry, area), [])
+            cache.put(('metro_employment', industry, area, min_date), df.iloc[rows], DEFAULT_TTL, get_query_tables(query.sql))
+
+def load_state_metro_employment(industries, areas, min_date):
+    return stream_state_metro_employment(get_connection_pool(), get_result_cache(), industries, areas, min_date)
+
+def build_us_cpi_df(us_anual_cpi_df):
+    df = us_anual_cpi_df.assign(YEAR=pd.DatetimeIndex(us_anual_cpi_df['DATE']).year)
+    return build_wide_df(df, 'YEAR', 'VARIABLE', US_CPI_LABELS)
+
+def build_us_jolts_df(us_employment_df):
+    df = us_employment_df.assign(YEAR=pd.DatetimeIndex(us_employment_df['DATE']).year)
+    return build_wide_df(df, 'YEAR', 'MEASURE', US_JOLTS_LABELS)
+
+def prepare_state_jolts_df(state_employment_df):
+    df = state_employment_df.assign(
+        YEAR=pd.DatetimeIndex(state_employment_df['DATE']).year,
+        GEO_ID=state_employment_df['ID'].str.split('/').str[1].astype(int))
+    return df.filter(items=['VALUE', 'MEASURE', 'GEO_NAME', 'GEO_ID', 'YEAR'])
+
+# One row per state with a column per JOLTS measure for the given year.
+def build_state_jolts_table(state_employment_df, year):
+    df = state_employment_df[state_employment_df['YEAR'] == year]
+    df = df.drop(['YEAR'], axis=1)
+    table = pd.pivot_table(df, index=['GEO_ID', 'GEO_NAME'], columns=['MEASURE'], observed=True)
+    table.columns = ['_'.join(str(s).strip() for s in col if s) for col in table.columns]
+    table.rename(columns={
+        "VALUE_Hires": "Hires", 
+        "VALUE_Job openings": "Job openings", 
+        "VALUE_Layoffs and discharges": "Layoffs and discharges",
+        "VALUE_Quits": "Quits",
+        "VALUE_Total separations": "Total separations",
+    }, inplace=True)
+    table.reset_index(inplace=True)
+    table['Other separations'] = table['Total separations'] - table['Quits'] - table['Layoffs and discharges']
+
+    return table
+
+def get_materialized_path(name):
+    return os.path.join(MATERIALIZED_DIR, f'{name}.parquet')
+
+# source_dates maps each timeseries table the frame was built from to its latest date at the time,
+# which is kept in the Parquet metadata to tell when a new release made the table stale.
+def save_materialized(name, df, source_dates = None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = get_materialized_path(name)
+    os.makedirs(MATERIALIZED_DIR, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    table = pa.Table.from_pandas(df)
+    dates = {table_name: pd.Timestamp(date).isoformat() for table_name, date in (source_dates or {}).items()}
+    table = table.replace_schema_metadata({**table.schema.metadata, b'source_dates': json.dumps(dates).encode()})
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+# The latest dates of the source tables of a query, for save_materialized
+def get_source_dates(query, latest_dates):
+    return {table: latest_dates[table] for table in get_query_tables(query.sql) if table in latest_dates}
+
+def read_materialized_source_dates(path):
+    import pyarrow.parquet as pq
+
+    return json.loads((pq.read_schema(path).metadata or {}).get(b'source_dates', b'{}'))
+
+# A materialized table is stale when one of its source tables has a newer latest date than the one it
+# was built from. Tables written without their source dates are always stale.
+def is_materialized_current(source_dates, latest_dates):
+    if (not source_dates):
+        return False
+    return all(pd.Timestamp(latest_dates[table]) <= pd.Timestamp(date) for table, date in source_dates.items() if table in latest_dates)
+
+# A table written by precompute.py, or None when it hasn't been materialized or, given the latest dates
+# of the timeseries tables from check_freshness, when it was built before the latest release. Tables
+# are cached until precompute.py rewrites them.
+def load_materialized(name, latest_dates = None):
+    path = get_materialized_path(name)
+    if (not os.path.exists(path)):
+        return None
+
+    cache = get_result_cache()
+    key = ('materialized', name, os.path.getmtime(path))
+    df = cache.get(key)
+    if (df is None):
+        df = pd.read_parquet(path)
+        df.attrs['source_dates'] = read_materialized_source_dates(path)
+        df = cache.put(key, df)
+
+    if (latest_dates is not None and not is_materialized_current(df.attrs['source_dates'], latest_dates)):
+        return None
+
+    return df
+
+def is_materialized(name, latest_dates):
+    path = get_materialized_path(name)
+    return os.path.exists(path) and is_materialized_current(read_materialized_source_dates(path), latest_dates)
+
+# The queries of all the pages whose results are not materialized, or whose materialized tables are stale.
+def get_warm_queries(latest_dates):
+    queries = [industries_query(), metro_areas_query(), monthly_cpi_query()]
+    if (not is_materialized('us_cpi', latest_dates)):
+        queries.append(us_annual_cpi_query())
+    if (not is_materialized('us_jolts', latest_dates)):
+        queries.append(us_employment_query())
+
+    return queries
+
+# Runs the queries of the pages through the result cache, so the pages not visited yet find their data cached.
+# The CPI page query depends on the latest date of the price data, from the freshness probe.
+def warm_cache(pool, cache, executor):
+    latest_dates = run_query(pool, cache, freshness_query()).set_index('TABLE_NAME')['MAX_DATE']
+    futures = [executor.submit(run_query, pool, cache, query) for query in get_warm_queries(latest_dates)]
+    if (not is_materialized('state_jolts_years', latest_dates)):
+        futures.append(executor.submit(run_reduced_query, pool, cache, state_employment_query(), prepare_state_jolts_df))
+    for future in futures:
+        future.result()
+
+# Streamlit has no hook for the server start, so the warmer is started once per server process by the
+# first page run, after the page rendered. The resources are passed in since cached resources can only
+# be read from a script thread. Nothing is warmed when a page is run without the server.
+@st.cache_resource
+def start_cache_warmer():
+    if (not runtime.exists()):
+        return None
 
-    return df
\ No newline at end of file
+    thread = threading.Thread(target=warm_cache, args=(get_connection_pool(), get_result_cache(), get_query_executor()),
+        name='cache-warmer', daemon=True)
+    thread.start()
+    return thread
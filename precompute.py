@@ -0,0 +1,45 @@
+# Materialize the tables rendered by the pages, so a rerun only reads a ready table instead of
+# pivoting the query results again. Run it after each data refresh:
+#
+#     python precompute.py [--workers 4]
+import argparse
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from functions import (ConnectionPool, concat_batches, freshness_query, get_source_dates, init_connection, read_query,
+    save_materialized, stream_query, build_state_jolts_table, build_us_cpi_df, build_us_jolts_df, prepare_state_jolts_df,
+    state_employment_query, us_annual_cpi_query, us_employment_query)
+
+def materialize_state_jolts_table(state_employment_df, year, source_dates):
+    save_materialized(f'state_jolts_{year}', build_state_jolts_table(state_employment_df, year), source_dates)
+    return year
+
+def main():
+    parser = argparse.ArgumentParser(description='Materialize the CPI and JOLTS tables rendered by the pages.')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    pool = ConnectionPool(init_connection, size=1)
+    # Probed before the data is read, so a release landing meanwhile makes the tables stale instead of hiding it
+    latest_dates = read_query(pool, freshness_query()).set_index('TABLE_NAME')['MAX_DATE']
+    us_anual_cpi_df = read_query(pool, us_annual_cpi_query())
+    us_employment_df = read_query(pool, us_employment_query())
+    state_employment_df = concat_batches(stream_query(pool, state_employment_query(), prepare_state_jolts_df))
+    print(f'Loaded the data in {time.perf_counter() - start:.1f}s')
+
+    save_materialized('us_cpi', build_us_cpi_df(us_anual_cpi_df), get_source_dates(us_annual_cpi_query(), latest_dates))
+    save_materialized('us_jolts', build_us_jolts_df(us_employment_df), get_source_dates(us_employment_query(), latest_dates))
+
+    state_source_dates = get_source_dates(state_employment_query(), latest_dates)
+    years = sorted(state_employment_df['YEAR'].unique())
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(materialize_state_jolts_table, state_employment_df[state_employment_df['YEAR'] == year], year, state_source_dates) for year in years]
+        for future in futures:
+            future.result()
+    save_materialized('state_jolts_years', state_employment_df.filter(items=['YEAR']).drop_duplicates().sort_values(by=['YEAR']), state_source_dates)
+
+    print(f'Materialized the US CPI and JOLTS tables and the state JOLTS tables of {len(years)} years in {time.perf_counter() - start:.1f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+import os
+import time
+import datetime
+import threading
+import duckdb
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+from functions import (ConnectionPool, FreshnessTracker, LocalConnection, Query, ResultCache, SeriesStore, bind_params, compute_cpi_changes, concat_batches,
+    get_cpi_window_start, get_size, is_materialized_current, lttb, refresh_caches, save_snapshot, stream_query,
+    stream_state_metro_employment)
+
+def test_lttb_keeps_the_ends_and_the_extremes():
+    x = np.arange(10000)
+    y = np.sin(x / 300)
+    y[2345] = 10
+    y[7654] = -10
+
+    indices = lttb(x, y, 200)
+
+    assert len(indices) == 200
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert np.all(np.diff(indices) > 0)
+    assert np.argmax(y) in indices
+    assert np.argmin(y) in indices
+
+def test_lttb_keeps_short_series_whole():
+    x = np.arange(10)
+    np.testing.assert_array_equal(lttb(x, x.astype('float64'), 10), x)
+    np.testing.assert_array_equal(lttb(x, x.astype('float64'), 500), x)
+
+def test_lttb_with_dates():
+    x = np.arange('2000-01-01', 1000, dtype='datetime64[D]')
+    indices = lttb(x, np.random.default_rng(0).random(1000), 50)
+    assert len(indices) == 50
+    assert indices[0] == 0 and indices[-1] == 999
+
+def test_series_store_slice_includes_both_ends():
+    store = SeriesStore()
+    store.put(('country/USA', 'CPI'), [2003, 2001, 2002, 2004, 2005], [3, 1, 2, 4, 5])
+
+    dates, values = store.slice(('country/USA', 'CPI'), 2002, 2004)
+    np.testing.assert_array_equal(dates, [2002, 2003, 2004])
+    np.testing.assert_array_equal(values, [2, 3, 4])
+
+    dates, _ = store.slice(('country/USA', 'CPI'), 2005, 2005)
+    np.testing.assert_array_equal(dates, [2005])
+    dates, _ = store.slice(('country/USA', 'CPI'))
+    assert len(dates) == 5
+    dates, _ = store.slice(('country/USA', 'CPI'), 2006)
+    assert len(dates) == 0
+
+def test_series_store_frame_and_invalidation():
+    store = SeriesStore()
+    store.put(('country/USA', 'A'), [1, 2, 3], [10, 20, 30], tables={'BLS_PRICE_TIMESERIES'})
+    store.put(('country/USA', 'B'), [1, 2, 3], [1, 2, 3], tables={'BLS_EMPLOYMENT_TIMESERIES'})
+
+    df = store.frame({'A': ('country/USA', 'A'), 'B': ('country/USA', 'B')}, 2, 3)
+    assert list(df.index) == [2, 3]
+    assert list(df['A']) == [20, 30]
+
+    store.downsample(('country/USA', 'A'), points=2)
+    assert store.invalidate_tables({'BLS_PRICE_TIMESERIES'}) == 1
+    assert not store.has([('country/USA', 'A')])
+    assert store.has([('country/USA', 'B')])
+    with pytest.raises(KeyError):
+        store.slice(('country/USA', 'A'))
+
+def test_result_cache_evicts_the_least_recently_used_entries_over_budget():
+    frame = pd.DataFrame({'VALUE': np.arange(100, dtype='float64')})
+    size = get_size(frame)
+    cache = ResultCache(max_bytes=size * 2)
+
+    cache.put('a', frame)
+    cache.put('b', frame.copy())
+    assert cache.get('a') is frame
+    cache.put('c', frame.copy())
+
+    assert cache.get('b') is None
+    assert cache.get('a') is frame
+    assert cache.get('c') is not None
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['bytes'] == size * 2
+    assert stats['evictions'] == 1
+
+def test_result_cache_skips_values_over_budget_and_expires_entries():
+    frame = pd.DataFrame({'VALUE': np.arange(100, dtype='float64')})
+    cache = ResultCache(max_bytes=get_size(frame) - 1)
+    assert cache.put('a', frame) is frame
+    assert cache.get('a') is None
+
+    cache = ResultCache()
+    cache.put('a', frame, ttl=0)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 0
+
+def test_bind_params_quotes_like_snowflake():
+    sql = 'SELECT * FROM T WHERE A IN (%(names)s) AND D >= %(date)s AND N = %(n)s AND B = %(b)s AND X IS %(x)s'
+    params = {'names': ["O'Hare", 'Dallas'], 'date': datetime.date(2023, 1, 1), 'n': 5, 'b': False, 'x': None}
+
+    assert bind_params(sql, params) == ("SELECT * FROM T WHERE A IN ('O''Hare', 'Dallas') AND D >= DATE '2023-01-01' "
+        + "AND N = 5 AND B = FALSE AND X IS NULL")
+    assert bind_params('SELECT * FROM T WHERE D >= %(date)s', {'date': datetime.datetime(2023, 3, 1)}) == (
+        "SELECT * FROM T WHERE D >= TIMESTAMP '2023-03-01 00:00:00'")
+    assert bind_params("SELECT '%' FROM T", None) == "SELECT '%' FROM T"
+
+def test_bind_params_keeps_the_first_month_of_a_timestamp_bound():
+    con = duckdb.connect()
+    con.execute("CREATE TABLE T AS SELECT * FROM (VALUES (DATE '2023-02-01'), (DATE '2023-03-01'), (DATE '2023-04-01')) AS v(D)")
+
+    sql = bind_params('SELECT COUNT(*) FROM T WHERE D >= %(date)s', {'date': datetime.datetime(2023, 3, 1)})
+    assert con.execute(sql).fetchone()[0] == 2
+
+def test_stream_query_writes_the_snapshot_batch_by_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(functions, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(functions, 'STREAM_BATCH_ROWS', 2)
+    monkeypatch.setattr(functions.metrics, 'path', None)
+    dates = pd.date_range('2023-01-01', periods=7, freq='MS').date
+    pd.DataFrame({'DATE': dates[:5], 'VALUE': np.arange(5, dtype='int8')}).to_parquet(tmp_path / 't.parquet')
+    pool = ConnectionPool(lambda: LocalConnection(str(tmp_path)))
+    query = Query('SELECT * FROM T', snapshot='t')
+
+    assert list(concat_batches(stream_query(pool, query))['VALUE']) == [0, 1, 2, 3, 4]
+    assert len(pd.read_parquet(tmp_path / 'snapshots' / 't.parquet')) == 5
+
+    # A refresh only fetches the rows after the snapshot, and appends them to it
+    pd.DataFrame({'DATE': dates, 'VALUE': np.arange(7, dtype='int16') * 100}).to_parquet(tmp_path / 't.parquet')
+    pool = ConnectionPool(lambda: LocalConnection(str(tmp_path)))
+    dfs = list(stream_query(pool, query))
+    assert list(dfs[0]['VALUE']) == [0, 1, 2, 3, 4]
+    assert list(concat_batches(dfs)['VALUE']) == [0, 1, 2, 3, 4, 500, 600]
+    assert list(pd.read_parquet(tmp_path / 'snapshots' / 't.parquet')['VALUE']) == [0, 1, 2, 3, 4, 500, 600]
+
+    monkeypatch.setattr(functions, 'STREAM_MAX_BYTES', 1)
+    with pytest.raises(RuntimeError):
+        list(stream_query(pool, Query('SELECT * FROM T', snapshot='u')))
+    assert sorted(os.listdir(tmp_path / 'snapshots')) == ['t.parquet']
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_connection_pool_closes_the_connection_of_a_failed_block():
+    connections = []
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    pool = ConnectionPool(connect, size=1)
+
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError()
+    with pool.connection() as conn:
+        pass
+
+    assert connections[0].closed
+    assert conn is connections[1] and not conn.closed
+    with pool.connection() as again:
+        assert again is conn
+
+def test_connection_pool_times_out_and_wakes_up_waiting_callers():
+    pool = ConnectionPool(FakeConnection, size=1, timeout=0.1)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            with pool.connection():
+                pass
+
+    pool = ConnectionPool(FakeConnection, size=1, timeout=5)
+    checked_out = []
+    def wait():
+        with pool.connection() as conn:
+            checked_out.append(conn)
+
+    with pytest.raises(ValueError):
+        with pool.connection() as failed:
+            thread = threading.Thread(target=wait)
+            thread.start()
+            time.sleep(0.1)
+            raise ValueError()
+    thread.join(1)
+
+    assert len(checked_out) == 1 and checked_out[0] is not failed
+
+def test_save_snapshot_appends_the_new_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(functions, 'SNAPSHOT_DIR', str(tmp_path))
+    stored_df = pd.DataFrame({'DATE': pd.to_datetime(['2023-01-01', '2023-02-01']), 'VALUE': [1.0, 2.0]})
+    new_df = pd.DataFrame({'DATE': pd.to_datetime(['2023-03-01']), 'VALUE': [3.0]})
+
+    save_snapshot('test', None, stored_df)
+    df = save_snapshot('test', stored_df, new_df)
+
+    assert list(df['VALUE']) == [1.0, 2.0, 3.0]
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / 'test.parquet'), df)
+    assert save_snapshot('test', df, new_df.iloc[0:0]) is df
+
+def test_compute_cpi_changes_per_series_and_by_period():
+    dates = pd.to_datetime(['2023-01-01', '2023-02-01', '2023-04-01', '2024-02-01'])
+    # The rows of the two geos are interleaved, and March is missing from both series
+    cpi_df = pd.DataFrame({
+        'GEO_ID': ['country/USA', 'geo/2', 'country/USA', 'geo/2', 'country/USA', 'geo/2', 'country/USA', 'geo/2'],
+        'VARIABLE': ['CPI'] * 8,
+        'DATE': dates.repeat(2),
+        'VALUE': [100.0, 200.0, 110.0, 100.0, 121.0, 150.0, 132.0, 300.0],
+    })
+
+    df = compute_cpi_changes(cpi_df)
+
+    usa = df[df['GEO_ID'] == 'country/USA']
+    np.testing.assert_allclose(usa['PERCENTAGE'], [np.nan, 10.0, np.nan, np.nan])
+    np.testing.assert_allclose(usa['YEAR OVER YEAR PERCENTAGE'], [np.nan, np.nan, np.nan, 20.0])
+    np.testing.assert_allclose(usa['ANNUALIZED PERCENTAGE'], [np.nan, (1.1 ** 12 - 1) * 100, np.nan, np.nan])
+    other = df[df['GEO_ID'] == 'geo/2']
+    np.testing.assert_allclose(other['PERCENTAGE'], [np.nan, -50.0, np.nan, np.nan])
+    np.testing.assert_allclose(other['YEAR OVER YEAR PERCENTAGE'], [np.nan, np.nan, np.nan, 200.0])
+    assert list(df.index) == list(cpi_df.index)
+
+def test_cpi_window_starts_13_months_back_across_a_year():
+    assert get_cpi_window_start(datetime.date(2024, 1, 1)) == pd.Timestamp('2022-12-01')
+    assert get_cpi_window_start(pd.Timestamp('2024-02-15')) == pd.Timestamp('2023-01-01')
+    assert get_cpi_window_start('2024-12-01') == pd.Timestamp('2023-11-01')
+
+def test_state_metro_employment_only_fetches_and_caches_the_missing_pairs(tmp_path, monkeypatch):
+    monkeypatch.setattr(functions.metrics, 'path', None)
+    industries = ['Government', 'Information']
+    areas = ['Dallas Metro Area', 'Austin Metro Area']
+    pd.DataFrame({'VARIABLE': ['gov', 'info'], 'REPORT': 'State and Metro Employment', 'INDUSTRY': industries,
+        'MEASURE': 'All Employees', 'FREQUENCY': 'Monthly', 'SEASONALLY_ADJUSTED': False}).to_parquet(tmp_path / 'bls_employment_attributes.parquet')
+    pd.DataFrame({'ID': ['geo/dallas', 'geo/austin'], 'GEO_NAME': areas, 'LEVEL': 'CensusCoreBasedStatisticalArea'}).to_parquet(
+        tmp_path / 'bls_geo_index.parquet')
+    pd.DataFrame({'GEO_ID': ['geo/dallas', 'geo/dallas', 'geo/austin', 'geo/austin'], 'VARIABLE': ['gov', 'info', 'gov', 'info'],
+        'DATE': datetime.date(2023, 1, 1), 'VALUE': [1.0, 2.0, 3.0, 4.0]}).to_parquet(tmp_path / 'bls_employment_timeseries.parquet')
+    pool = ConnectionPool(lambda: LocalConnection(str(tmp_path)))
+    cache = ResultCache()
+    min_date = datetime.date(2022, 1, 1)
+    cached_df = pd.DataFrame({'GEO_NAME': ['Dallas Metro Area'], 'INDUSTRY': ['Government'], 'DATE': [datetime.date(2023, 1, 1)],
+        'VALUE': [1.0], 'MONTH': ['2023-01']})
+    cache.put(('metro_employment', 'Government', 'Dallas Metro Area', min_date), cached_df)
+
+    # Waco has no rows, which is cached as empty series so they aren't queried again
+    dfs = list(stream_state_metro_employment(pool, cache, industries, areas + ['Waco Metro Area'], min_date))
+
+    assert dfs[0].equals(cached_df)
+    fetched = concat_batches(dfs[1:])
+    assert sorted(zip(fetched['INDUSTRY'], fetched['GEO_NAME'], fetched['VALUE'])) == [
+        ('Government', 'Austin Metro Area', 3.0), ('Information', 'Austin Metro Area', 4.0), ('Information', 'Dallas Metro Area', 2.0)]
+    assert cache.get(('metro_employment', 'Government', 'Dallas Metro Area', min_date)) is cached_df
+    assert list(cache.get(('metro_employment', 'Information', 'Dallas Metro Area', min_date))['VALUE']) == [2.0]
+    assert cache.get(('metro_employment', 'Government', 'Waco Metro Area', min_date)).empty
+
+def test_result_cache_invalidates_only_the_entries_of_the_given_tables():
+    cache = ResultCache()
+    cache.put('price', 1, tables={'BLS_PRICE_TIMESERIES'})
+    cache.put('employment', 2, tables={'BLS_EMPLOYMENT_TIMESERIES'})
+    cache.put('probe', 3, tables={'BLS_PRICE_TIMESERIES'})
+
+    assert cache.invalidate_tables({'BLS_PRICE_TIMESERIES'}, keep=['probe']) == 1
+    assert cache.get('price') is None
+    assert cache.get('employment') == 2
+    assert cache.get('probe') == 3
+
+def test_refresh_caches_drops_only_what_was_read_from_tables_with_a_new_release(tmp_path, monkeypatch):
+    monkeypatch.setattr(functions, 'FRESHNESS_TTL', 0)
+    monkeypatch.setattr(functions.metrics, 'path', None)
+    def write_table(name, last_month):
+        pd.DataFrame({'DATE': pd.date_range('2023-01-01', last_month, freq='MS').date, 'VALUE': 1.0}).to_parquet(tmp_path / f'{name}.parquet')
+
+    write_table('bls_price_timeseries', '2023-06-01')
+    write_table('bls_employment_timeseries', '2023-05-01')
+    pool = ConnectionPool(lambda: LocalConnection(str(tmp_path)))
+    cache, store, tracker = ResultCache(), SeriesStore(), FreshnessTracker()
+
+    dates = refresh_caches(pool, cache, store, tracker)
+    assert dates.loc['BLS_PRICE_TIMESERIES', 'MAX_DATE'] == datetime.date(2023, 6, 1)
+    cache.put('price', 1, tables={'BLS_PRICE_TIMESERIES'})
+    cache.put('employment', 2, tables={'BLS_EMPLOYMENT_TIMESERIES'})
+    store.put(('country/USA', 'CPI'), [1, 2], [1, 2], tables={'BLS_PRICE_TIMESERIES'})
+
+    refresh_caches(pool, cache, store, tracker)
+    assert cache.get('price') == 1
+
+    write_table('bls_price_timeseries', '2023-07-01')
+    dates = refresh_caches(pool, cache, store, tracker)
+    assert dates.loc['BLS_PRICE_TIMESERIES', 'MAX_DATE'] == datetime.date(2023, 7, 1)
+    assert cache.get('price') is None
+    assert cache.get('employment') == 2
+    assert not store.has([('country/USA', 'CPI')])
+
+def test_freshness_tracker_reports_the_tables_that_changed():
+    tracker = FreshnessTracker()
+    assert tracker.update({'A': 1, 'B': 1}) == set()
+    assert tracker.update({'A': 2, 'B': 1}) == {'A'}
+    assert tracker.update({'A': 2, 'B': 1}) == set()
+
+def test_materialized_tables_are_current_up_to_the_latest_release():
+    latest = {'BLS_PRICE_TIMESERIES': datetime.date(2023, 6, 1), 'BLS_EMPLOYMENT_TIMESERIES': datetime.date(2023, 5, 1)}
+
+    assert is_materialized_current({'BLS_PRICE_TIMESERIES': '2023-06-01'}, latest)
+    assert not is_materialized_current({'BLS_PRICE_TIMESERIES': '2023-05-01'}, latest)
+    assert not is_materialized_current({'BLS_PRICE_TIMESERIES': '2023-06-01', 'BLS_EMPLOYMENT_TIMESERIES': '2023-04-01'}, latest)
+    assert is_materialized_current({'BLS_PRICE_TIMESERIES': '2023-06-01', 'OTHER': '2000-01-01'}, latest)
+    assert not is_materialized_current({}, latest)